@@ -1,18 +1,51 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
 from typing import List, Optional, Dict, Any
-from datetime import datetime, date
-from decimal import Decimal, ROUND_HALF_UP
-import numpy_financial as npf
+import numba
+import numpy as np
 import pandas as pd
 from dataclasses import dataclass
+from datetime import datetime
+import asyncio
+from functools import lru_cache
+from cachetools import TTLCache
+import hashlib
 import json
-import requests
+import httpx
+import orjson
 import os
+import threading
 
-app = FastAPI(title="Israeli Mortgage Engine", version="1.0.0")
+app = FastAPI(title="Israeli Mortgage Engine", version="1.0.0", default_response_class=ORJSONResponse)
+
+class StreamAwareGZipMiddleware:
+    """GZipMiddleware that passes the given streaming paths through uncompressed.
+    
+    Starlette 0.27's gzip responder never flushes between chunks, so a
+    streamed body would reach the client only once it is complete.
+    """
+    
+    def __init__(self, app, minimum_size: int = 500, streaming_paths: frozenset = frozenset()):
+        self.app = app
+        self.gzip_app = GZipMiddleware(app, minimum_size=minimum_size)
+        self.streaming_paths = streaming_paths
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.streaming_paths:
+            await self.app(scope, receive, send)
+        else:
+            await self.gzip_app(scope, receive, send)
+
+# Amortization tables compress very well; small responses and NDJSON streams are left alone
+app.add_middleware(StreamAwareGZipMiddleware, minimum_size=1024, streaming_paths=frozenset({"/amortization-stream"}))
+
+# Per-user calculations: browsers may keep them, shared caches must not
+AMORTIZATION_CACHE_CONTROL = "private, max-age=0"
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -143,21 +176,74 @@ class UpdateMortgageRequest(BaseModel):
 class UpdateMortgageResponse(BaseModel):
     updated_mortgage_state: MortgageState
     changes_applied: Dict[str, Any]
+    schedule_hash: Optional[str] = None
+
+# Compiled schedule loop: one pass computes every row, no temporary arrays
+@numba.njit(cache=True, fastmath=True)
+def _amortize(rate, monthly_payment, balance, months, grace_months, balloon):
+    table = np.empty((4, months))
+    monthly_rate = rate / 12
+    
+    for i in range(months):
+        interest = balance * monthly_rate
+        payment = interest if i < grace_months else monthly_payment
+        principal = payment - interest
+        balance -= principal
+        
+        if balloon and i == months - 1:  # Last payment includes the full principal
+            payment += balance
+            principal += balance
+            balance = 0.0
+        
+        table[0, i] = payment
+        table[1, i] = principal
+        table[2, i] = interest
+        table[3, i] = max(balance, 0.0)
+    
+    return table
+
+# Batched variant for plain level-payment tracks: every track is accumulated
+# straight into one combined table instead of materializing per-track schedules
+@numba.njit(cache=True, fastmath=True)
+def _amortize_batch(rates, monthly_payments, balances, periods, months):
+    table = np.zeros((4, months))
+    
+    for t in range(rates.shape[0]):
+        monthly_rate = rates[t] / 12
+        balance = balances[t]
+        
+        for i in range(min(periods[t], months)):
+            interest = balance * monthly_rate
+            principal = monthly_payments[t] - interest
+            balance -= principal
+            
+            table[0, i] += monthly_payments[t]
+            table[1, i] += principal
+            table[2, i] += interest
+            table[3, i] += max(balance, 0.0)
+    
+    return table
 
 # Core Engine Logic
 class MortgageEngine:
     
     @staticmethod
     def calculate_payment(rate: float, periods: int, principal: float) -> float:
-        """Calculate monthly payment using numpy financial PMT"""
-        if rate == 0:
+        """Calculate monthly payment using the closed-form PMT formula"""
+        monthly_rate = rate / 12
+        if monthly_rate == 0:
             return principal / periods
-        return float(npf.pmt(rate / 12, periods, -principal))
+        return principal * monthly_rate / (1 - (1 + monthly_rate) ** -periods)
+    
+    @staticmethod
+    def cpi_factor(market_conditions: MarketConditions) -> float:
+        """CPI adjustment applied to index-linked balances"""
+        return market_conditions.current_cpi_index / market_conditions.base_cpi_index
     
     @staticmethod
     def calculate_track_payment(track: MortgageTrack, market_conditions: MarketConditions, 
-                              calculation_date: str) -> PaymentBreakdown:
-        """Calculate payment for a single track"""
+                              calculation_date: str, cpi_factor: Optional[float] = None) -> PaymentBreakdown:
+        """Calculate payment for a single track (cpi_factor is derived from market_conditions if omitted)"""
         
         if track.remaining_months <= 0:
             return PaymentBreakdown(
@@ -178,8 +264,9 @@ class MortgageEngine:
             
         elif track.track_type == "index_linked_variable":
             # Adjust balance for CPI
-            cpi_factor = market_conditions.current_cpi_index / market_conditions.base_cpi_index
-            current_balance = track.original_amount * cpi_factor * (track.current_balance / track.original_amount)
+            if cpi_factor is None:
+                cpi_factor = MortgageEngine.cpi_factor(market_conditions)
+            current_balance = track.current_balance * cpi_factor
             
         elif track.track_type == "grace_period" and track.is_interest_only:
             # Grace period - interest only
@@ -210,239 +297,407 @@ class MortgageEngine:
         )
     
     @staticmethod
-    def generate_amortization_table(track: MortgageTrack, market_conditions: MarketConditions,
-                                   start_date: str, months: int = 12) -> List[AmortizationEntry]:
-        """Generate amortization table for a track with grace period and bridge loan support"""
-        table = []
+    @lru_cache(maxsize=256)
+    def monthly_dates(start_date: str, months: int) -> np.ndarray:
+        """Payment dates one month apart, clamping the day to the end of shorter months.
+        
+        Cached and read-only: every track and table computed for the same
+        calculation date shares one array.
+        """
+        start = np.datetime64(datetime.strptime(start_date, "%Y-%m-%d").date(), "D")
+        first_month = start.astype("datetime64[M]")
+        month_starts = (first_month + np.arange(months)).astype("datetime64[D]")
+        month_ends = (first_month + np.arange(1, months + 1)).astype("datetime64[D]") - 1
+        day_offset = start - first_month.astype("datetime64[D]")
+        dates = np.datetime_as_string(np.minimum(month_starts + day_offset, month_ends), unit="D")
+        dates.setflags(write=False)
+        return dates
+    
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def schedule(rate: float, periods: int, balance: float, months: int,
+                 grace_months: int = 0, balloon: bool = False) -> np.ndarray:
+        """Cached 4 x months schedule: interest-only for grace_months, then level payments over periods.
+        
+        The returned array is shared between callers and is read-only.
+        """
+        monthly_payment = 0.0
+        if months > grace_months:
+            monthly_payment = MortgageEngine.calculate_payment(rate, periods, balance)
+        
+        table = _amortize(float(rate), float(monthly_payment), float(balance), months, grace_months, balloon)
+        table.setflags(write=False)
+        return table
+    
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def batch_schedule(rates: tuple, periods: tuple, balances: tuple, months: int) -> np.ndarray:
+        """Cached 4 x months sum of several level-payment schedules, one per (rate, periods, balance).
+        
+        The returned array is shared between callers and is read-only.
+        """
+        monthly_payments = [
+            MortgageEngine.calculate_payment(rate, n, balance)
+            for rate, n, balance in zip(rates, periods, balances)
+        ]
+        table = _amortize_batch(
+            np.array(rates, dtype=np.float64), np.array(monthly_payments, dtype=np.float64),
+            np.array(balances, dtype=np.float64), np.array(periods, dtype=np.int64), months
+        )
+        table.setflags(write=False)
+        return table
+    
+    @staticmethod
+    def track_terms(track: MortgageTrack, market_conditions: MarketConditions,
+                    cpi_factor: Optional[float] = None) -> tuple[float, float]:
+        """Current rate and balance of a track, quantized for use as schedule cache keys"""
         balance = track.current_balance
-        current_date = datetime.strptime(start_date, "%Y-%m-%d")
         
         # Handle CPI adjustment for index-linked tracks
         if track.track_type == "index_linked_variable":
-            cpi_factor = market_conditions.current_cpi_index / market_conditions.base_cpi_index
-            balance = track.original_amount * cpi_factor * (balance / track.original_amount)
+            if cpi_factor is None:
+                cpi_factor = MortgageEngine.cpi_factor(market_conditions)
+            balance *= cpi_factor
         
         current_rate = track.rate
         if track.track_type == "variable_prime":
             current_rate = market_conditions.current_prime_rate
         
+        return round(current_rate, 10), round(balance, 10)
+    
+    @staticmethod
+    def track_schedule(track: MortgageTrack, market_conditions: MarketConditions,
+                       months: int = 12, cpi_factor: Optional[float] = None) -> np.ndarray:
+        """Payment, principal, interest and balance rows (shape 4 x n) for a track's next months"""
+        current_rate, balance = MortgageEngine.track_terms(track, market_conditions, cpi_factor)
+        
+        # The full-term schedule is cached; shorter requests are slices of it
+        months = max(months, 0)
+        
         # Handle different track types
         if track.track_type == "bridge":
             # Bridge loan: interest-only + balloon payment at the end
-            bridge_months = track.bridge_period_months or track.total_term_months
-            monthly_interest = balance * (current_rate / 12)
-            
-            for i in range(min(months, bridge_months)):
-                payment_num = track.payments_made + i + 1
-                
-                if i == bridge_months - 1:  # Last payment includes balloon
-                    entry = AmortizationEntry(
-                        payment_number=payment_num,
-                        date=current_date.strftime("%Y-%m-%d"),
-                        payment=monthly_interest + balance,  # Interest + principal balloon
-                        principal=balance,  # Full principal at end
-                        interest=monthly_interest,
-                        balance=0  # Paid off
-                    )
-                    balance = 0
-                else:
-                    entry = AmortizationEntry(
-                        payment_number=payment_num,
-                        date=current_date.strftime("%Y-%m-%d"),
-                        payment=monthly_interest,
-                        principal=0,
-                        interest=monthly_interest,
-                        balance=balance  # No principal reduction
-                    )
-                
-                table.append(entry)
-                current_date = datetime(current_date.year + (current_date.month // 12), 
-                                      ((current_date.month % 12) + 1), current_date.day)
-        
-        elif track.track_type == "grace_period":
+            bridge_months = max(track.bridge_period_months or track.total_term_months, 0)
+            return MortgageEngine.schedule(
+                current_rate, 0, balance, bridge_months,
+                grace_months=bridge_months, balloon=True
+            )[:, :months]
+        
+        full_term = max(track.remaining_months, 0)
+        if track.track_type == "grace_period":
             # Grace period: interest-only for grace months, then regular amortization
             grace_months = track.grace_period_months or 0
-            total_months = min(months, track.remaining_months)
-            
-            for i in range(total_months):
-                payment_num = track.payments_made + i + 1
-                
-                if i < grace_months:
-                    # Grace period: interest-only
-                    monthly_interest = balance * (current_rate / 12)
-                    entry = AmortizationEntry(
-                        payment_number=payment_num,
-                        date=current_date.strftime("%Y-%m-%d"),
-                        payment=monthly_interest,
-                        principal=0,
-                        interest=monthly_interest,
-                        balance=balance
-                    )
-                else:
-                    # After grace: regular amortization for remaining term
-                    remaining_months = track.total_term_months - grace_months
-                    monthly_payment = abs(npf.pmt(current_rate / 12, remaining_months, -balance))
-                    interest = balance * (current_rate / 12)
-                    principal = monthly_payment - interest
-                    balance -= principal
-                    
-                    entry = AmortizationEntry(
-                        payment_number=payment_num,
-                        date=current_date.strftime("%Y-%m-%d"),
-                        payment=monthly_payment,
-                        principal=principal,
-                        interest=interest,
-                        balance=max(0, balance)
-                    )
-                
-                table.append(entry)
-                current_date = datetime(current_date.year + (current_date.month // 12), 
-                                      ((current_date.month % 12) + 1), current_date.day)
+            return MortgageEngine.schedule(
+                current_rate, track.total_term_months - grace_months, balance, full_term,
+                grace_months=grace_months
+            )[:, :months]
         
-        else:
-            # Regular loan: standard amortization
-            monthly_payment = abs(npf.pmt(current_rate / 12, track.remaining_months, -balance))
-            
-            for i in range(min(months, track.remaining_months)):
-                interest = balance * (current_rate / 12)
-                principal = monthly_payment - interest
-                balance -= principal
-                
-                entry = AmortizationEntry(
-                    payment_number=track.payments_made + i + 1,
-                    date=current_date.strftime("%Y-%m-%d"),
-                    payment=monthly_payment,
-                    principal=principal,
-                    interest=interest,
-                    balance=max(0, balance)
-                )
-                
-                table.append(entry)
-                current_date = datetime(current_date.year + (current_date.month // 12), 
-                                      ((current_date.month % 12) + 1), current_date.day)
+        # Regular loan: standard amortization
+        return MortgageEngine.schedule(current_rate, track.remaining_months, balance, full_term)[:, :months]
+    
+    @staticmethod
+    def generate_amortization_table(track: MortgageTrack, market_conditions: MarketConditions,
+                                   start_date: str, months: int = 12) -> List[AmortizationEntry]:
+        """Generate amortization table for a track with grace period and bridge loan support"""
+        schedule = MortgageEngine.track_schedule(track, market_conditions, months)
+        dates = MortgageEngine.monthly_dates(start_date, max(months, 0))[:schedule.shape[1]]
         
-        return table
+        # Rows come from already-validated floats; skip per-field validation
+        return [
+            AmortizationEntry.model_construct(
+                payment_number=track.payments_made + i + 1,
+                date=entry_date,
+                payment=payment,
+                principal=principal,
+                interest=interest,
+                balance=balance
+            )
+            for i, (entry_date, payment, principal, interest, balance)
+            in enumerate(zip(dates.tolist(), *schedule.tolist()))
+        ]
     
     @staticmethod
-    def generate_combined_amortization_table(tracks: List[MortgageTrack], market_conditions: MarketConditions,
-                                           start_date: str, months: int = 12) -> List[AmortizationEntry]:
-        """Generate combined amortization table for all tracks"""
-        # Get individual track tables
-        all_track_tables = []
+    def combined_schedule(tracks: List[MortgageTrack], market_conditions: MarketConditions,
+                          months: int = 12, cpi_factor: Optional[float] = None) -> np.ndarray:
+        """Rounded payment, principal, interest and balance totals (shape 4 x n) across all tracks"""
+        if cpi_factor is None:
+            cpi_factor = MortgageEngine.cpi_factor(market_conditions)
+        
+        # All tracks start at the calculation date, so month i of every schedule lines up
+        months = max(months, 0)
+        totals = np.zeros((4, months))
+        n = 0
+        
+        # Plain level-payment tracks are summed together in one batched kernel call
+        level_tracks = [
+            track for track in tracks
+            if track.track_type not in ("bridge", "grace_period") and track.remaining_months > 0
+        ]
+        if level_tracks:
+            terms = [MortgageEngine.track_terms(track, market_conditions, cpi_factor) for track in level_tracks]
+            periods = tuple(track.remaining_months for track in level_tracks)
+            schedule = MortgageEngine.batch_schedule(
+                tuple(rate for rate, _ in terms), periods, tuple(balance for _, balance in terms), max(periods)
+            )[:, :months]
+            totals[:, :schedule.shape[1]] += schedule
+            n = schedule.shape[1]
+        
         for track in tracks:
-            track_table = MortgageEngine.generate_amortization_table(
-                track, market_conditions, start_date, months
-            )
-            all_track_tables.extend(track_table)
+            if track.track_type in ("bridge", "grace_period"):
+                schedule = MortgageEngine.track_schedule(track, market_conditions, months, cpi_factor)
+                totals[:, :schedule.shape[1]] += schedule
+                n = max(n, schedule.shape[1])
+        totals = totals[:, :n]
+        np.round(totals, 2, out=totals)
+        return totals
+    
+    @staticmethod
+    def combined_amortization_rows(tracks: List[MortgageTrack], market_conditions: MarketConditions,
+                                   start_date: str, months: int = 12, offset: int = 0,
+                                   cpi_factor: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Combined amortization rows as plain dicts, starting `offset` months in"""
+        totals = MortgageEngine.combined_schedule(tracks, market_conditions, months, cpi_factor)
+        dates = MortgageEngine.monthly_dates(start_date, max(months, 0))
+        return MortgageEngine.amortization_rows(
+            totals, dates, MortgageEngine.first_payment_number(tracks), offset, totals.shape[1]
+        )
+    
+    @staticmethod
+    def first_payment_number(tracks: List[MortgageTrack]) -> int:
+        """Number of the first combined row; numbering continues from the least-advanced track"""
+        return min((track.payments_made for track in tracks), default=0) + 1
+    
+    @staticmethod
+    def amortization_rows(totals: np.ndarray, dates: np.ndarray, first_payment: int,
+                          start: int, stop: int) -> List[Dict[str, Any]]:
+        """Row dicts for months [start, stop) of a combined 4 x n totals array"""
+        start, stop = max(start, 0), min(stop, totals.shape[1])
         
-        # Group by payment number and combine
-        combined_payments = {}
+        return [
+            {
+                "payment_number": first_payment + i,
+                "date": entry_date,
+                "payment": payment,
+                "principal": principal,
+                "interest": interest,
+                "balance": balance
+            }
+            for i, (entry_date, payment, principal, interest, balance)
+            in enumerate(zip(dates[start:stop].tolist(), *totals[:, start:stop].tolist()), start=start)
+        ]
+    
+    @staticmethod
+    def generate_combined_amortization_table(tracks: List[MortgageTrack], market_conditions: MarketConditions,
+                                           start_date: str, months: int = 12, offset: int = 0,
+                                           cpi_factor: Optional[float] = None) -> List[AmortizationEntry]:
+        """Generate combined amortization table for all tracks, starting `offset` months in"""
+        rows = MortgageEngine.combined_amortization_rows(
+            tracks, market_conditions, start_date, months, offset, cpi_factor
+        )
         
-        for entry in all_track_tables:
-            payment_num = entry.payment_number
-            
-            if payment_num not in combined_payments:
-                combined_payments[payment_num] = {
-                    'payment_number': payment_num,
-                    'date': entry.date,
-                    'payment': 0.0,
-                    'principal': 0.0,
-                    'interest': 0.0,
-                    'balance': 0.0
-                }
-            
-            combined_payments[payment_num]['payment'] += entry.payment
-            combined_payments[payment_num]['principal'] += entry.principal
-            combined_payments[payment_num]['interest'] += entry.interest
-            combined_payments[payment_num]['balance'] += entry.balance
-        
-        # Convert to AmortizationEntry objects and sort
-        combined_table = []
-        for payment_num in sorted(combined_payments.keys()):
-            data = combined_payments[payment_num]
-            combined_table.append(AmortizationEntry(
-                payment_number=data['payment_number'],
-                date=data['date'],
-                payment=round(data['payment'], 2),
-                principal=round(data['principal'], 2),
-                interest=round(data['interest'], 2),
-                balance=round(data['balance'], 2)
-            ))
-        
-        return combined_table
+        # Rows come from already-validated floats; skip per-field validation
+        return [AmortizationEntry.model_construct(**row) for row in rows]
+    
+    @staticmethod
+    def schedule_hash(mortgage_state: MortgageState, monthly_changes: MonthlyChanges) -> str:
+        """Digest of every input to a calculation (tracks, market conditions, changes, calculation date).
+        
+        Any previous amortization table is an output, not an input, so it is left out.
+        """
+        digest = hashlib.sha256(mortgage_state.model_dump_json(exclude={"amortization_table"}).encode())
+        digest.update(monthly_changes.model_dump_json().encode())
+        return digest.hexdigest()
     
     @staticmethod
-    def update_mortgage_state(mortgage_state: MortgageState, 
-                            monthly_changes: MonthlyChanges) -> tuple[MortgageState, Dict[str, Any]]:
-        """Update mortgage state with new market conditions"""
+    def update_mortgage_state(mortgage_state: MortgageState, monthly_changes: MonthlyChanges,
+                            months: Optional[int] = None) -> tuple[MortgageState, Dict[str, Any]]:
+        """Update mortgage state with new market conditions, tabulating at most `months` months"""
         
         changes_applied = {}
         
         # Update market conditions
-        new_market_conditions = mortgage_state.market_conditions.model_copy()
+        market_updates = {}
         
         if monthly_changes.new_prime_rate is not None:
             changes_applied["prime_rate_change"] = {
-                "old": new_market_conditions.current_prime_rate,
+                "old": mortgage_state.market_conditions.current_prime_rate,
                 "new": monthly_changes.new_prime_rate
             }
-            new_market_conditions.current_prime_rate = monthly_changes.new_prime_rate
+            market_updates["current_prime_rate"] = monthly_changes.new_prime_rate
         
         if monthly_changes.new_cpi_index is not None:
             changes_applied["cpi_change"] = {
-                "old": new_market_conditions.current_cpi_index,
+                "old": mortgage_state.market_conditions.current_cpi_index,
                 "new": monthly_changes.new_cpi_index
             }
-            new_market_conditions.current_cpi_index = monthly_changes.new_cpi_index
+            market_updates["current_cpi_index"] = monthly_changes.new_cpi_index
+        
+        new_market_conditions = mortgage_state.market_conditions
+        if market_updates:
+            new_market_conditions = new_market_conditions.model_copy(update=market_updates)
         
         # Calculate new payments for each track
         payment_breakdown = []
         total_payment = 0
+        cpi_factor = MortgageEngine.cpi_factor(new_market_conditions)
         
         for track in mortgage_state.tracks:
             breakdown = MortgageEngine.calculate_track_payment(
-                track, new_market_conditions, monthly_changes.calculation_date
+                track, new_market_conditions, monthly_changes.calculation_date, cpi_factor
             )
             payment_breakdown.append(breakdown)
             total_payment += breakdown.payment
         
-        # Generate combined amortization table (ALL remaining months)
+        # Generate combined amortization table (ALL remaining months unless capped)
         max_months = max([track.remaining_months for track in mortgage_state.tracks] + [0])
+        if months is not None:
+            max_months = min(max_months, months)
         amortization_table = MortgageEngine.generate_combined_amortization_table(
-            mortgage_state.tracks, new_market_conditions, monthly_changes.calculation_date, max_months
+            mortgage_state.tracks, new_market_conditions, monthly_changes.calculation_date, max_months,
+            cpi_factor=cpi_factor
         )
         
-        # Create updated mortgage state
-        updated_state = mortgage_state.model_copy()
-        updated_state.market_conditions = new_market_conditions
-        updated_state.current_monthly_payment = MonthlyPayment(
-            total_payment=total_payment,
-            breakdown=payment_breakdown
-        )
-        updated_state.last_calculation_date = monthly_changes.calculation_date
-        updated_state.amortization_table = amortization_table
+        # Create updated mortgage state - a shallow copy, every replaced field is new
+        updated_state = mortgage_state.model_copy(update={
+            "market_conditions": new_market_conditions,
+            "current_monthly_payment": MonthlyPayment(
+                total_payment=total_payment,
+                breakdown=payment_breakdown
+            ),
+            "last_calculation_date": monthly_changes.calculation_date,
+            "amortization_table": amortization_table
+        }, deep=False)
         
         return updated_state, changes_applied
 
 # API Endpoints
-@app.post("/update-mortgage", response_model=UpdateMortgageResponse)
-async def update_mortgage(request: UpdateMortgageRequest):
+# Calculation inputs per (mortgage_id, schedule_hash), for paging through the full schedule.
+# The hash covers the whole request, so different mortgages sharing an id never collide.
+# The endpoints using it run in the threadpool, hence the lock.
+_amortization_inputs: TTLCache = TTLCache(maxsize=256, ttl=3600)
+_amortization_inputs_lock = threading.Lock()
+
+# The handler reads the raw body, so its schema is declared for OpenAPI by hand.
+# Nested models are referenced as components and merged in by _openapi below.
+_UPDATE_REQUEST_SCHEMA = UpdateMortgageRequest.model_json_schema(ref_template="#/components/schemas/{model}")
+_UPDATE_REQUEST_DEFS = _UPDATE_REQUEST_SCHEMA.pop("$defs", {})
+
+@app.post(
+    "/update-mortgage", response_model=UpdateMortgageResponse, response_class=ORJSONResponse,
+    openapi_extra={"requestBody": {
+        "content": {"application/json": {"schema": {"$ref": "#/components/schemas/UpdateMortgageRequest"}}},
+        "required": True
+    }}
+)
+async def update_mortgage(request: Request, months: int = Query(60, ge=0, le=360)):
     """
-    Update mortgage state with new market conditions and calculate new payments
+    Update mortgage state with new market conditions and calculate new payments.
+    The amortization table covers the first `months` months (0 = the whole remaining term);
+    use /amortization-table for the rest.
+    
+    The body (an UpdateMortgageRequest) comes from our own frontend, so it is
+    parsed straight from JSON in strict mode. Parsing and the calculation are
+    pure CPU work and run in the threadpool instead of blocking the event loop.
     """
+    body = await request.body()
+    return await run_in_threadpool(_update_mortgage, body, months or None)
+
+def _update_mortgage(body: bytes, months: Optional[int]) -> Response:
+    try:
+        update_request = UpdateMortgageRequest.model_validate_json(body, strict=True)
+    except ValidationError as e:
+        raise RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)])
+    
     try:
         updated_state, changes = MortgageEngine.update_mortgage_state(
-            request.mortgage_state, request.monthly_changes
+            update_request.mortgage_state, update_request.monthly_changes, months
         )
         
-        return UpdateMortgageResponse(
+        schedule_hash = MortgageEngine.schedule_hash(update_request.mortgage_state, update_request.monthly_changes)
+        with _amortization_inputs_lock:
+            _amortization_inputs[(updated_state.mortgage_id, schedule_hash)] = (
+                updated_state.tracks, updated_state.market_conditions, updated_state.last_calculation_date
+            )
+        
+        # Serialized directly by pydantic-core, skipping FastAPI's response encoding
+        response = UpdateMortgageResponse(
             updated_mortgage_state=updated_state,
-            changes_applied=changes
+            changes_applied=changes,
+            schedule_hash=schedule_hash
+        )
+        return Response(
+            content=response.model_dump_json(), media_type="application/json",
+            headers={"Cache-Control": AMORTIZATION_CACHE_CONTROL}
         )
     
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error updating mortgage: {str(e)}")
 
+_default_openapi = app.openapi
+
+def _openapi() -> Dict[str, Any]:
+    if app.openapi_schema is None:
+        schemas = _default_openapi().setdefault("components", {}).setdefault("schemas", {})
+        for name, schema in {**_UPDATE_REQUEST_DEFS, "UpdateMortgageRequest": _UPDATE_REQUEST_SCHEMA}.items():
+            schemas.setdefault(name, schema)
+    return app.openapi_schema
+
+app.openapi = _openapi
+
+@app.get("/amortization-table")
+def get_amortization_table(response: Response, mortgage_id: str, schedule_hash: str,
+                           offset: int = Query(0, ge=0), limit: int = Query(60, ge=1, le=360)):
+    """
+    Slice of the combined amortization table computed by a previous /update-mortgage call
+    """
+    with _amortization_inputs_lock:
+        inputs = _amortization_inputs.get((mortgage_id, schedule_hash))
+    if inputs is None:
+        raise HTTPException(status_code=404, detail="No cached schedule for this mortgage calculation")
+    
+    tracks, market_conditions, calculation_date = inputs
+    response.headers["Cache-Control"] = AMORTIZATION_CACHE_CONTROL
+    total_months = max([track.remaining_months for track in tracks] + [0])
+    
+    # Plain dicts straight from the schedule arrays; orjson encodes them without model objects
+    return {
+        "mortgage_id": mortgage_id,
+        "offset": offset,
+        "limit": limit,
+        "total_months": total_months,
+        "amortization_table": MortgageEngine.combined_amortization_rows(
+            tracks, market_conditions, calculation_date, min(offset + limit, total_months), offset
+        )
+    }
+
+@app.get("/amortization-stream")
+def stream_amortization_table(mortgage_id: str, schedule_hash: str):
+    """
+    Full combined amortization table of a previous /update-mortgage call, as NDJSON (one row per line)
+    """
+    with _amortization_inputs_lock:
+        inputs = _amortization_inputs.get((mortgage_id, schedule_hash))
+    if inputs is None:
+        raise HTTPException(status_code=404, detail="No cached schedule for this mortgage calculation")
+    
+    tracks, market_conditions, calculation_date = inputs
+    total_months = max([track.remaining_months for track in tracks] + [0])
+    
+    def rows():
+        totals = MortgageEngine.combined_schedule(tracks, market_conditions, total_months)
+        dates = MortgageEngine.monthly_dates(calculation_date, total_months)
+        first_payment = MortgageEngine.first_payment_number(tracks)
+        
+        # One chunk per year of payments, so the client can render while the rest is encoded
+        for start in range(0, totals.shape[1], 12):
+            tile = MortgageEngine.amortization_rows(totals, dates, first_payment, start, start + 12)
+            yield b"".join(orjson.dumps(row) + b"\n" for row in tile)
+    
+    return StreamingResponse(
+        rows(), media_type="application/x-ndjson",
+        headers={"Cache-Control": AMORTIZATION_CACHE_CONTROL, "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/api/health")
 async def health_check():
     return {"message": "Israeli Mortgage Engine API", "version": "1.0.0", "status": "healthy"}
@@ -452,88 +707,130 @@ class BankComparisonRequest(BaseModel):
     loan_years: int
     loan_interest: str
 
+# Pooled client for the Bank Jerusalem proxy, with all required headers
+BANK_JERUSALEM_API_URL = "https://calculator.bankjerusalem.co.il/jerusalem/api_calc"
+_bank_client = httpx.AsyncClient(
+    timeout=10.0,
+    headers={
+        'Accept': 'application/json, text/javascript, */*; q=0.01',
+        'Accept-Language': 'en-US,en;q=0.9,he;q=0.8',
+        'Cache-Control': 'no-cache',
+        'Connection': 'keep-alive',
+        'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+        'Origin': 'https://calculator.bankjerusalem.co.il',
+        'Pragma': 'no-cache',
+        'Referer': 'https://calculator.bankjerusalem.co.il/',
+        'Sec-Fetch-Dest': 'empty',
+        'Sec-Fetch-Mode': 'cors',
+        'Sec-Fetch-Site': 'same-origin',
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36',
+        'X-Requested-With': 'XMLHttpRequest',
+        'sec-ch-ua': '"Not;A=Brand";v="99", "Google Chrome";v="139", "Chromium";v="139"',
+        'sec-ch-ua-mobile': '?0',
+        'sec-ch-ua-platform': '"macOS"'
+    }
+)
+
+# The bank expects three mix entries; only the first one is ever filled in,
+# so the serialized "mix" field is built once with %-placeholders for it
+_EMPTY_MIX_ENTRY = json.dumps({
+    "loan_board": "1",
+    "loan_type": "1|0",
+    "loan_value": "",
+    "loan_years": 0,
+    "loan_interest": "",
+    "update_interest": 0
+})
+_MIX_TEMPLATE = (
+    '[{"loan_board": "1", "loan_type": "1|0", "loan_value": %s, "loan_years": %d, '
+    '"loan_interest": %s, "update_interest": 0}, ' + _EMPTY_MIX_ENTRY + ', ' + _EMPTY_MIX_ENTRY + ']'
+)
+
+# Successful bank results for repeated comparisons, kept for a minute
+_bank_cache: TTLCache = TTLCache(maxsize=256, ttl=60)
+
+# Upstream calls in flight per key; concurrent callers await the same future,
+# so a success or a failure reaches all of them at once
+_bank_requests: Dict[tuple, asyncio.Future] = {}
+
+@app.on_event("shutdown")
+async def close_bank_client():
+    await _bank_client.aclose()
+
+async def _fetch_bank_comparison(request: BankComparisonRequest) -> Dict[str, Any]:
+    # Prepare the data exactly as Bank Jerusalem expects it
+    bank_data = {
+        "mix": _MIX_TEMPLATE % (
+            json.dumps(request.loan_value), request.loan_years, json.dumps(request.loan_interest)
+        )
+    }
+    
+    # Call Bank Jerusalem API over the shared keep-alive connection
+    response = await _bank_client.post(BANK_JERUSALEM_API_URL, data=bank_data)
+    
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f"Bank API returned: {response.status_code}")
+        
+    # Try to parse JSON response
+    try:
+        bank_result = response.json()
+    except json.JSONDecodeError:
+        # If JSON parsing fails, return the raw text for debugging
+        return {
+            "success": False,
+            "error": "Invalid JSON response from bank",
+            "raw_response": response.text[:500]  # First 500 chars for debugging
+        }
+    
+    return {
+        "success": True,
+        "bank_result": bank_result,
+        "status_code": response.status_code
+    }
+
+async def _lead_bank_comparison(cache_key: tuple, request: BankComparisonRequest) -> Dict[str, Any]:
+    pending = asyncio.get_running_loop().create_future()
+    _bank_requests[cache_key] = pending
+    try:
+        result = await _fetch_bank_comparison(request)
+    except Exception as e:
+        pending.set_exception(e)
+        raise
+    except BaseException:
+        # Leader cancelled (client went away): waiters still get an answer
+        pending.set_exception(HTTPException(status_code=503, detail="Bank API request was cancelled"))
+        raise
+    else:
+        if result["success"]:
+            _bank_cache[cache_key] = result
+        pending.set_result(result)
+        return result
+    finally:
+        # Mark the outcome as retrieved so a failure nobody waited for is not logged
+        pending.exception()
+        del _bank_requests[cache_key]
+
 @app.post("/proxy-bank-api")
 async def proxy_bank_jerusalem_api(request: BankComparisonRequest):
     """
     Proxy endpoint to call Bank Jerusalem API (avoids CORS issues)
     """
+    cache_key = (request.loan_value, request.loan_years, request.loan_interest)
+    
     try:
-        # Prepare the data exactly as Bank Jerusalem expects it
-        bank_data = {
-            "mix": json.dumps([
-                {
-                    "loan_board": "1",
-                    "loan_type": "1|0",
-                    "loan_value": request.loan_value,
-                    "loan_years": request.loan_years,
-                    "loan_interest": request.loan_interest,
-                    "update_interest": 0
-                },
-                {
-                    "loan_board": "1",
-                    "loan_type": "1|0", 
-                    "loan_value": "",
-                    "loan_years": 0,
-                    "loan_interest": "",
-                    "update_interest": 0
-                },
-                {
-                    "loan_board": "1",
-                    "loan_type": "1|0",
-                    "loan_value": "",
-                    "loan_years": 0,
-                    "loan_interest": "",
-                    "update_interest": 0
-                }
-            ])
-        }
-        
-        # Call Bank Jerusalem API with all required headers
-        response = requests.post(
-            "https://calculator.bankjerusalem.co.il/jerusalem/api_calc",
-            headers={
-                'Accept': 'application/json, text/javascript, */*; q=0.01',
-                'Accept-Language': 'en-US,en;q=0.9,he;q=0.8',
-                'Cache-Control': 'no-cache',
-                'Connection': 'keep-alive',
-                'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-                'Origin': 'https://calculator.bankjerusalem.co.il',
-                'Pragma': 'no-cache',
-                'Referer': 'https://calculator.bankjerusalem.co.il/',
-                'Sec-Fetch-Dest': 'empty',
-                'Sec-Fetch-Mode': 'cors',
-                'Sec-Fetch-Site': 'same-origin',
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36',
-                'X-Requested-With': 'XMLHttpRequest',
-                'sec-ch-ua': '"Not;A=Brand";v="99", "Google Chrome";v="139", "Chromium";v="139"',
-                'sec-ch-ua-mobile': '?0',
-                'sec-ch-ua-platform': '"macOS"'
-            },
-            data=bank_data,
-            timeout=10
-        )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail=f"Bank API returned: {response.status_code}")
-            
-        # Try to parse JSON response
-        try:
-            bank_result = response.json()
-        except json.JSONDecodeError:
-            # If JSON parsing fails, return the raw text for debugging
-            return {
-                "success": False,
-                "error": "Invalid JSON response from bank",
-                "raw_response": response.text[:500]  # First 500 chars for debugging
-            }
-        
-        return {
-            "success": True,
-            "bank_result": bank_result,
-            "status_code": response.status_code
-        }
+        result = _bank_cache.get(cache_key)
+        if result is None:
+            pending = _bank_requests.get(cache_key)
+            if pending is not None:
+                # shield: a waiter leaving must not cancel the call others wait on
+                result = await asyncio.shield(pending)
+            else:
+                result = await _lead_bank_comparison(cache_key, request)
+        return result
         
-    except requests.RequestException as e:
+    except HTTPException:
+        raise
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=503, detail=f"Failed to connect to Bank Jerusalem API: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Proxy error: {str(e)}")